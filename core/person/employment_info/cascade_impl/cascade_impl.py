@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import re
+import threading
+import unicodedata
+from functools import lru_cache
+from itertools import islice, compress
+from os.path import commonprefix
+from typing import Optional, Iterable, Iterator, Dict
+
+from ahocorasick import Automaton
+
+from person.employment_info.domain import EntitiesRecognizer, Text, load_morph, allowed_symbols_table, \
+    SENTENCE_BOUNDARY
+from person.employment_info.natasha_impl.natasha_impl import NatashaEntitiesRecognizer
+from person.employment_info.static import read_raw_job_titles, load_job_titles_artifact
+
+WORD = re.compile(r'[^\W\d_]+')
+
+
+class CascadeEntitiesRecognizer(EntitiesRecognizer):
+    """
+    Runs the wrapped recognizer only on texts that may produce a Work, which needs a person
+    with a company or a job in one sentence. Persons and companies are expected to be capitalized,
+    so a text is skipped when no sentence has two capitalized words and the text has either no
+    capitalized words or no job title stems. The counters of PersonInfoExtractor.extract_many workers
+    are added to the recognizer of the parent process.
+    """
+
+    def __init__(self, recognizer: Optional[EntitiesRecognizer] = None):
+        self.recognizer = recognizer or NatashaEntitiesRecognizer()
+        self.recognized = 0
+        self.skipped = 0
+        self.__lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # Copies start counting from zero
+        return {'recognizer': self.recognizer}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state['recognizer'])
+
+    @property
+    def skip_rate(self) -> float:
+        total = self.recognized + self.skipped
+        return self.skipped / total if total else 0.0
+
+    @property
+    def job_stems(self) -> Automaton:
+        return load_job_stems()
+
+    def recognize_entities(self, text: str) -> Text:
+        if not self.__may_have_work(text):
+            self.__count(0, 1)
+            return Text(text, '', [])
+        self.__count(1, 0)
+        return self.recognizer.recognize_entities(text)
+
+    def recognize_entities_batch(self, texts: Iterable[str], batch_size: int = 32) -> Iterator[Text]:
+        texts = iter(texts)
+        for batch in iter(lambda: list(islice(texts, batch_size)), []):
+            candidates = [self.__may_have_work(text) for text in batch]
+            self.__count(sum(candidates), len(batch) - sum(candidates))
+            recognized = self.recognizer.recognize_entities_batch(compress(batch, candidates), batch_size)
+            for text, candidate in zip(batch, candidates):
+                yield next(recognized) if candidate else Text(text, '', [])
+
+    def pop_counters(self) -> Dict[str, int]:
+        with self.__lock:
+            counters = {'recognized': self.recognized, 'skipped': self.skipped}
+            self.recognized = self.skipped = 0
+        return counters
+
+    def add_counters(self, counters: Dict[str, int]) -> None:
+        self.__count(counters.get('recognized', 0), counters.get('skipped', 0))
+
+    def __count(self, recognized: int, skipped: int) -> None:
+        with self.__lock:
+            self.recognized += recognized
+            self.skipped += skipped
+
+    def __may_have_work(self, text: str) -> bool:
+        capitalized = 0
+        for sentence in SENTENCE_BOUNDARY.split(text):
+            sentence_capitalized = [i for i, word in enumerate(WORD.findall(sentence)) if word[0].isupper()]
+            # A person and a company are two capitalized words of one sentence, only one of them starts it
+            if len(sentence_capitalized) > 1:
+                return True
+            capitalized += len(sentence_capitalized)
+        # Job titles are looked up in the whole text, sentences may be split at abbreviations
+        return capitalized > 0 and next(self.job_stems.iter(_fold(text)), None) is not None
+
+
+def _fold(text: str) -> str:
+    # The same letters as in the normalized text, without punctuation
+    return unicodedata.normalize('NFKD', text).lower().translate(allowed_symbols_table)
+
+
+##########
+# Models #
+##########
+
+@lru_cache(maxsize=None)
+def load_job_stems() -> Automaton:
+    return load_job_titles_artifact('cascade_job_stems', _eval_job_stems, 'pyahocorasick')
+
+
+def _eval_job_stems() -> Automaton:
+    # Common prefixes of all the forms of the first title words, so that any inflected form matches
+    automaton = Automaton()
+    for title in read_raw_job_titles():
+        words = title.split()
+        if not words:
+            continue
+        for parse in load_morph().parse(words[0]):
+            forms = {_fold(form.word) for form in parse.lexeme} | {_fold(parse.normal_form)}
+            stem = commonprefix(list(forms))
+            for pattern in [stem] if stem else forms:
+                automaton.add_word(pattern, pattern)
+    automaton.make_automaton()
+    return automaton
@@ -1,18 +1,25 @@
 from __future__ import annotations
 
+import re
 import string
 from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right
 from copy import copy
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum, auto
+from functools import lru_cache
 from itertools import product, chain
-from typing import List, Tuple, Optional, Callable
+from typing import List, Tuple, Optional, Callable, Dict, Iterable, Iterator
 
 import nltk
 import pymorphy2
 import unicodedata
 
 
+# Sentence ends as split by the extraction windows and the cascade screen, no language model needed
+SENTENCE_BOUNDARY = re.compile(r'[.!?…]+\s|\n')
+
+
 class EntityType(Enum):
     NONE = auto()
     PER = auto()
@@ -23,6 +30,9 @@ class EntityType(Enum):
 
 @dataclass
 class Token:
+    # Millions of tokens are held for large corpora, slots spare the per instance dict
+    __slots__ = ('text', 'start_pos', 'end_pos', 'norm_text', 'norm_start_pos', 'norm_end_pos', 'entity', 'match')
+
     text: str
     start_pos: int
     end_pos: int
@@ -31,6 +41,10 @@ class Token:
     norm_end_pos: int
     entity: EntityType
 
+    def __post_init__(self):
+        # The match the token entity was tagged by, if any
+        self.match: Optional[TextMatch] = None
+
     def concat(self, token: Token) -> None:
         self.text = (self.text + ' ' + token.text).strip()
         self.end_pos = token.end_pos
@@ -61,26 +75,69 @@ class Token:
         return closest
 
 
+class TokenPositionIndex:
+    """ Closest token lookup by bisect, giving the same token as Token.eval_closest_token """
+
+    def __init__(self, tokens: List[Token]):
+        self.tokens = tokens
+        self.coordinates = [coordinate for token in tokens for coordinate in token.coordinates]
+        # Overlapping or unordered tokens are scanned as before
+        self.ordered = all(a <= b for a, b in zip(self.coordinates, self.coordinates[1:]))
+
+    def eval_closest_token(self, token: Token) -> Optional[Token]:
+        if not self.ordered or not self.tokens:
+            return token.eval_closest_token(self.tokens)
+        distance = min(self.__eval_distance(coordinate) for coordinate in token.coordinates)
+        # The first token having a coordinate at that distance wins ties, as in the scan
+        closest = min(
+            self.__find_coordinate(coordinate + shift)
+            for coordinate in token.coordinates for shift in (-distance, distance)
+        )
+        return self.tokens[closest // 2]
+
+    def __eval_distance(self, coordinate: int) -> int:
+        i = bisect_left(self.coordinates, coordinate)
+        return min(abs(coordinate - c) for c in self.coordinates[max(i - 1, 0):i + 1])
+
+    def __find_coordinate(self, coordinate: int) -> int:
+        i = bisect_left(self.coordinates, coordinate)
+        return i if i < len(self.coordinates) and self.coordinates[i] == coordinate else len(self.coordinates)
+
+
 @dataclass
 class Sentence:
     tokens: List[Token]
+    _entities_cache: Optional[tuple] = field(default=None, init=False, repr=False, compare=False)
 
     @property
     def entities(self) -> List[Token]:
-        concat_tokens = []
-        for token in self.tokens:
-            if not concat_tokens:
-                concat_tokens.append(copy(token))
-                continue
-            lst = concat_tokens[-1]
-            if token.entity != EntityType.NONE and lst.entity == token.entity:
-                lst.concat(token)
-            else:
-                concat_tokens.append(copy(token))
-        return [token for token in concat_tokens if token.entity != EntityType.NONE]
+        return list(self.__eval_entities()[0])
 
     def calc_entities_by_type(self, entity_type: EntityType) -> List[Token]:
-        return list(e for e in self.entities if e.entity == entity_type)
+        return list(self.__eval_entities()[1].get(entity_type, ()))
+
+    def __eval_entities(self) -> Tuple[List[Token], Dict[EntityType, List[Token]]]:
+        # Recomputed only when the tokens or their entities change, the held tokens compare by identity first
+        signature = (tuple(self.tokens), tuple(token.entity for token in self.tokens))
+        if self._entities_cache is None or self._entities_cache[0] != signature:
+            entities = self.__concat_entities()
+            entities_by_type = {}
+            for entity in entities:
+                entities_by_type.setdefault(entity.entity, []).append(entity)
+            self._entities_cache = (signature, entities, entities_by_type)
+        return self._entities_cache[1], self._entities_cache[2]
+
+    def __concat_entities(self) -> List[Token]:
+        entities = []
+        previous = None
+        for token in self.tokens:
+            if token.entity != EntityType.NONE:
+                if previous is not None and previous.entity == token.entity:
+                    entities[-1].concat(token)
+                else:
+                    entities.append(copy(token))
+            previous = token
+        return entities
 
     @property
     def norm_text(self):
@@ -151,44 +208,116 @@ class TextMatch:
     end: int
 
 
+class NormTextBuilder:
+    def __init__(self):
+        self.parts: List[str] = []
+        self.length = 0
+
+    def append(self, text: str) -> None:
+        self.parts.append(text)
+        self.length += len(text)
+
+    def strip(self) -> None:
+        # Same as str.strip on the text built so far, without copying it
+        parts = self.parts
+        while parts and not parts[-1].strip():
+            self.length -= len(parts.pop())
+        while parts and not parts[0].strip():
+            self.length -= len(parts.pop(0))
+        if parts:
+            self.length -= len(parts[-1])
+            parts[-1] = parts[-1].rstrip()
+            self.length += len(parts[-1])
+            self.length -= len(parts[0])
+            parts[0] = parts[0].lstrip()
+            self.length += len(parts[0])
+
+    def build(self) -> str:
+        return ''.join(self.parts)
+
+
 class EntitiesRecognizer(ABC):
     @abstractmethod
     def recognize_entities(self, text: str) -> Text:
         pass
 
+    def recognize_entities_batch(self, texts: Iterable[str], batch_size: int = 32) -> Iterator[Text]:
+        for text in texts:
+            yield self.recognize_entities(text)
+
+    def pop_counters(self) -> Dict[str, int]:
+        # Counters gathered since the last call, reported by the worker process copies of the recognizer
+        return {}
+
+    def add_counters(self, counters: Dict[str, int]) -> None:
+        pass
+
     @classmethod
     def _set_entity(cls, sentences: List[Sentence], norm_text: str, tokens_interval_func: Callable[[str],
                     list[TextMatch]], entity_type: EntityType) -> None:
-        tokens_intervals: list[TextMatch] = tokens_interval_func(norm_text)
+        tokens_intervals = cls._merge_intervals(tokens_interval_func(norm_text))
         for sentence in sentences:
             for token in sentence.tokens:
-                if token.entity == EntityType.NONE and cls._is_token_in_intervals(token, tokens_intervals):
-                    token.entity = entity_type
+                if token.entity == EntityType.NONE:
+                    match = cls._find_token_interval(token, tokens_intervals)
+                    if match is not None:
+                        token.entity = entity_type
+                        token.match = match
+
+    @staticmethod
+    def _merge_intervals(token_intervals: list[TextMatch]) -> Tuple[List[int], List[int], List[TextMatch]]:
+        # Sorted disjoint starts and ends covering the same positions as the intervals,
+        # with the first interval of each group of overlapping ones
+        starts, ends, intervals = [], [], []
+        for interval in sorted(token_intervals, key=lambda i: i.start):
+            if interval.start >= interval.end:
+                continue
+            if ends and interval.start < ends[-1]:
+                ends[-1] = max(ends[-1], interval.end)
+            else:
+                starts.append(interval.start)
+                ends.append(interval.end)
+                intervals.append(interval)
+        return starts, ends, intervals
 
     @staticmethod
-    def _is_token_in_intervals(token: Token, token_intervals: list[TextMatch]) -> bool:
-        for interval in token_intervals:
-            if interval.start <= token.norm_start_pos < interval.end:
-                return True
-        return False
+    def _find_token_interval(token: Token, token_intervals: Tuple[List[int], List[int], List[TextMatch]]) \
+            -> Optional[TextMatch]:
+        starts, ends, intervals = token_intervals
+        i = bisect_right(starts, token.norm_start_pos) - 1
+        if i >= 0 and token.norm_start_pos < ends[i]:
+            return intervals[i]
 
 
 #########
 # Utils #
 #########
 
-morph = pymorphy2.MorphAnalyzer()
+@lru_cache(maxsize=None)
+def load_morph() -> pymorphy2.MorphAnalyzer:
+    return pymorphy2.MorphAnalyzer()
+
+
+NORMALIZE_CACHE_SIZE = 2 ** 16
+
+
+class _AllowedSymbolsTable(dict):
+    ALLOWED_SYMBOLS = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя 1234567890' + string.ascii_lowercase
+
+    def __missing__(self, key: int) -> Optional[int]:
+        self[key] = key if chr(key) in self.ALLOWED_SYMBOLS else None
+        return self[key]
+
+
+allowed_symbols_table = _AllowedSymbolsTable()
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_word(word: str) -> str:
+    return load_morph().parse(word)[0].normal_form.lower().translate(allowed_symbols_table)
 
 
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
 def normalize_text(text: str) -> str:
-    norm_text = text
-    norm_text = unicodedata.normalize("NFKD", norm_text)
-    norm_text = ' '.join(
-        morph.parse(word)[0].normal_form.lower()
-        for word in nltk.word_tokenize(norm_text)
-    )
-    allowed_symbols = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя 1234567890' + string.ascii_lowercase
-    for s in set(norm_text):
-        if s not in allowed_symbols:
-            norm_text = norm_text.replace(s, '')
-    return norm_text.strip()
+    norm_text = unicodedata.normalize("NFKD", text)
+    return ' '.join(normalize_word(word) for word in nltk.word_tokenize(norm_text)).strip()
@@ -1,39 +1,90 @@
 from __future__ import annotations
 
-from typing import List, Optional
+from functools import lru_cache
+from itertools import islice
+from typing import List, Optional, Iterable, Iterator, Tuple, Dict
 
 from natasha import NewsEmbedding, Segmenter, NewsNERTagger, MorphVocab, Doc
-from natasha.doc import DocToken, DocSent
+from natasha.doc import DocToken, adapt_spans
 from natasha.norm import normalize, syntax_normalize
+from slovnet.exec.encoders import TagEncoder
+from slovnet.exec.infer import NERInfer
 
 from person.employment_info.domain import EntitiesRecognizer, Text, EntityType, Sentence, Token, normalize_text
-from person.employment_info.static import read_raw_job_titles
+from person.employment_info.domain import TextMatch, NormTextBuilder
+from person.employment_info.static import read_raw_job_titles, load_job_titles_artifact
 from person.employment_info.time_interval.time_interval_parser import parse_date_intervals
 
 
+class JobTitlesParserTrie:
+    TERMINAL = None
+
+    def __init__(self, tokenized_titles: Iterable[list[str]]):
+        self.trie = {}
+        for title in tokenized_titles:
+            if not title:
+                continue
+            node = self.trie
+            for token in title:
+                node = node.setdefault(token, {})
+            node[self.TERMINAL] = True
+
+    def findall(self, tokens: list[str]) -> list[TextMatch]:
+        # Longest title per start token, start/end are token indices
+        matches = []
+        for start in range(len(tokens)):
+            node, end = self.trie, None
+            for i in range(start, len(tokens)):
+                node = node.get(tokens[i])
+                if node is None:
+                    break
+                if self.TERMINAL in node:
+                    end = i + 1
+            if end is not None:
+                matches.append(TextMatch(' '.join(tokens[start:end]), start, end))
+        return matches
+
+
 class NatashaEntitiesRecognizer(EntitiesRecognizer):
-    def __init__(self):
-        self.emb = NewsEmbedding()
-        self.segmenter = Segmenter()
-        self.ner_tagger = NewsNERTagger(self.emb)
-        self.morph_vocab = MorphVocab()
-        self.tokenized_norm_job_titles = self.__eval_tokenized_norm_job_titles()
-
-    def __eval_tokenized_norm_job_titles(self) -> list[list[str]]:
-        tokenized_norm_job_titles = []
-        raw_titles = read_raw_job_titles()
-        for raw_title in raw_titles:
-            doc = Doc(raw_title)
-            doc.segment(self.segmenter)
-            tokenized_norm_job_title = [normalize_text(token.text) for token in doc.tokens]
-            tokenized_norm_job_titles.append(tokenized_norm_job_title)
-        return tokenized_norm_job_titles
+    @property
+    def emb(self) -> NewsEmbedding:
+        return load_embedding()
+
+    @property
+    def segmenter(self) -> Segmenter:
+        return load_segmenter()
+
+    @property
+    def ner_tagger(self) -> NewsNERTagger:
+        return load_ner_tagger()
+
+    @property
+    def morph_vocab(self) -> MorphVocab:
+        return load_morph_vocab()
+
+    @property
+    def tokenized_norm_job_titles(self) -> list[list[str]]:
+        return load_job_titles()[0]
+
+    @property
+    def jobs_parser(self) -> JobTitlesParserTrie:
+        return load_job_titles()[1]
 
     def recognize_entities(self, text: str) -> Text:
-        sentences, norm_text = self.__recognize_named_entities_natasha(text)
+        return self.__recognize_entities(self.__eval_doc(text))
+
+    def recognize_entities_batch(self, texts: Iterable[str], batch_size: int = 32) -> Iterator[Text]:
+        # The NER model runs on batch_size documents at once, the rest is done per document
+        texts = iter(texts)
+        for batch in iter(lambda: list(islice(texts, batch_size)), []):
+            for doc in self.__eval_docs(batch, batch_size):
+                yield self.__recognize_entities(doc)
+
+    def __recognize_entities(self, doc: Doc) -> Text:
+        sentences, norm_text = self.__recognize_named_entities_natasha(doc)
         self.__set_job_entities(sentences)
         self._set_entity(sentences, norm_text, parse_date_intervals, EntityType.TIME)
-        return Text(text, norm_text, sentences)
+        return Text(doc.text, norm_text, sentences)
 
     def __eval_doc(self, text: str) -> Doc:
         doc = Doc(text)
@@ -43,34 +94,56 @@ class NatashaEntitiesRecognizer(EntitiesRecognizer):
             span.normalize(self.morph_vocab)
         return doc
 
-    def __recognize_named_entities_natasha(self, text: str) -> (List[Sentence], str):
-        doc = self.__eval_doc(text)
-        norm_text = ''
+    def __eval_docs(self, texts: List[str], batch_size: int) -> List[Doc]:
+        # Same as __eval_doc, with the tagging of Doc.tag_ner done for all the documents together
+        docs = [Doc(text) for text in texts]
+        for doc in docs:
+            doc.segment(self.segmenter)
+            doc.spans = []
+        tagged_docs = [doc for doc in docs if doc.text.strip()]
+        markups = load_ner_infer(batch_size)([doc.text for doc in tagged_docs])
+        for doc, markup in zip(tagged_docs, markups):
+            doc.spans = list(adapt_spans(doc, markup.spans))
+            doc.envelop_span_tokens()
+            doc.envelop_sent_spans()
+        for doc in docs:
+            for span in doc.spans:
+                span.normalize(self.morph_vocab)
+        return docs
+
+    def __recognize_named_entities_natasha(self, doc: Doc) -> (List[Sentence], str):
+        entities = self.__eval_entities(doc)
+        norm_text = NormTextBuilder()
         sentences = []
         for sent in doc.sents:
             tokens = []
             for token in sent.tokens:
-                token_entity_str = self.__eval_entity(token, sent)
+                token_entity_str = entities.get(id(token))
                 named_entity = self.__map_entity(token_entity_str)
                 token_norm_text = self.__normalize(token, token_entity_str) if named_entity != EntityType.NONE \
                     else normalize_text(token.text)
                 domain_token = Token(
                     token.text, token.start, token.stop,
-                    token_norm_text, len(norm_text), len(norm_text) + len(token_norm_text),
+                    token_norm_text, norm_text.length, norm_text.length + len(token_norm_text),
                     named_entity
                 )
                 tokens.append(domain_token)
-                norm_text += token_norm_text.strip() + ' '
+                norm_text.append(token_norm_text.strip() + ' ')
             sentences.append(Sentence(tokens))
-            norm_text = norm_text.strip() + '.'
-        return sentences, norm_text
+            norm_text.strip()
+            norm_text.append('.')
+        return sentences, norm_text.build()
 
     @staticmethod
-    def __eval_entity(token: DocToken, sent: DocSent) -> str:
-        for span in sent.spans:
-            for span_token in span.tokens:
-                if span_token is token:
-                    return span.type
+    def __eval_entities(doc: Doc) -> Dict[int, str]:
+        # Span type by token identity, the first span of the token sentence wins
+        entities = {}
+        for sent in doc.sents:
+            # Sentences of a blank text are never enveloped with spans
+            for span in sent.spans or ():
+                for span_token in span.tokens:
+                    entities.setdefault(id(span_token), span.type)
+        return entities
 
     @staticmethod
     def __map_entity(type: str) -> EntityType:
@@ -87,9 +160,52 @@ class NatashaEntitiesRecognizer(EntitiesRecognizer):
     def __set_job_entities(self, sentences: List[Sentence]) -> None:
         for sentence in sentences:
             sentence_norm_tokens = [token.norm_text for token in sentence.tokens]
-            for job_title in self.tokenized_norm_job_titles:
-                for start in range(len(sentence_norm_tokens) - len(job_title) + 1):
-                    end = start + len(job_title)
-                    if job_title == sentence_norm_tokens[start:end]:
-                        for token in sentence.tokens[start:end]:
-                            token.entity = EntityType.JOB
+            for match in self.jobs_parser.findall(sentence_norm_tokens):
+                for token in sentence.tokens[match.start:match.end]:
+                    token.entity = EntityType.JOB
+
+
+##########
+# Models #
+##########
+
+@lru_cache(maxsize=None)
+def load_embedding() -> NewsEmbedding:
+    return NewsEmbedding()
+
+
+@lru_cache(maxsize=None)
+def load_segmenter() -> Segmenter:
+    return Segmenter()
+
+
+@lru_cache(maxsize=None)
+def load_ner_tagger() -> NewsNERTagger:
+    return NewsNERTagger(load_embedding())
+
+
+@lru_cache(maxsize=None)
+def load_ner_infer(batch_size: int) -> NERInfer:
+    # The tagger model with another batch size
+    infer = load_ner_tagger().infer
+    encoder = TagEncoder(infer.encoder.words_vocab, infer.encoder.shapes_vocab, batch_size)
+    return NERInfer(infer.model, encoder, infer.decoder)
+
+
+@lru_cache(maxsize=None)
+def load_morph_vocab() -> MorphVocab:
+    return MorphVocab()
+
+
+@lru_cache(maxsize=None)
+def load_job_titles() -> Tuple[list[list[str]], JobTitlesParserTrie]:
+    return load_job_titles_artifact('natasha_job_titles', _eval_job_titles, 'natasha', 'razdel', 'nltk')
+
+
+def _eval_job_titles() -> Tuple[list[list[str]], JobTitlesParserTrie]:
+    tokenized_norm_job_titles = []
+    for raw_title in read_raw_job_titles():
+        doc = Doc(raw_title)
+        doc.segment(load_segmenter())
+        tokenized_norm_job_titles.append([normalize_text(token.text) for token in doc.tokens])
+    return tokenized_norm_job_titles, JobTitlesParserTrie(tokenized_norm_job_titles)
@@ -1,38 +1,111 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import List
+import os
+import re
+from collections import deque, defaultdict, Counter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from copy import copy
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import List, Iterable, Iterator, Tuple, Optional, Dict, Set
 
-from person.employment_info.domain import TextPersonInfo, Work, EntityType, Text, EntitiesRecognizer
+from person.employment_info.domain import TextPersonInfo, Work, EntityType, Text, EntitiesRecognizer, \
+    TokenPositionIndex, Token, SENTENCE_BOUNDARY
 from person.employment_info.natasha_impl.natasha_impl import NatashaEntitiesRecognizer
-from person.employment_info.time_interval.time_interval_parser import parse_date_interval
+from person.employment_info.time_interval.time_interval_parser import parse_date_interval, TimeIntervalMatch
+
+WHITESPACE = re.compile(r'\s')
 
 
 @dataclass
 class PersonInfoExtractor:
 
-    nlp: EntitiesRecognizer = NatashaEntitiesRecognizer()
+    nlp: EntitiesRecognizer = field(default_factory=NatashaEntitiesRecognizer)
 
     def extract(self, text: str) -> List[TextPersonInfo]:
         entities_text = self.nlp.recognize_entities(text)
         works = self.__group_entities_by_person(entities_text)
         return self.__group_persons_by_normalized_name(works)
 
+    def extract_many(self, texts: Iterable[Tuple[str, str]], workers: Optional[int] = None, chunksize: int = 1,
+                     ordered: bool = True) -> Iterator[Tuple[str, List[TextPersonInfo]]]:
+        if workers == 1:
+            for source_id, text in texts:
+                yield source_id, self.extract(text)
+            return
+        workers = workers or os.cpu_count()
+        texts = iter(texts)
+        chunks = iter(lambda: list(islice(texts, chunksize)), [])
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(self.nlp,)) as executor:
+            # Bounded number of chunks in flight, texts are consumed lazily
+            pending = deque(executor.submit(_extract_chunk, chunk) for chunk in islice(chunks, 2 * workers))
+            while pending:
+                if ordered:
+                    done = [pending.popleft()]
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+                pending.extend(executor.submit(_extract_chunk, chunk) for chunk in islice(chunks, len(done)))
+                for future in done:
+                    results, counters = future.result()
+                    self.nlp.add_counters(counters)
+                    yield from results
+
+    def extract_stream(self, chunks: Iterable[str], window_size: int = 2 ** 16) -> Iterator[Work]:
+        # Recognizes windows of whole sentences, so only about window_size characters are held at once.
+        # Token start_pos and end_pos are shifted to the stream, norm positions stay window relative.
+        buffer, offset = '', 0
+        for chunk in chunks:
+            buffer += chunk
+            while len(buffer) >= window_size:
+                end = _find_window_end(buffer, window_size)
+                yield from self.__extract_window(buffer[:end], offset)
+                buffer, offset = buffer[end:], offset + end
+        if buffer:
+            yield from self.__extract_window(buffer, offset)
+
+    def __extract_window(self, window: str, offset: int) -> Iterator[Work]:
+        for work in self.__group_entities_by_person(self.nlp.recognize_entities(window)):
+            # The work tokens are the ones cached by the sentences, shifted copies are yielded
+            work.person = _shift_token(work.person, offset)
+            work.companies = [_shift_token(token, offset) for token in work.companies]
+            work.jobs = [_shift_token(token, offset) for token in work.jobs]
+            yield work
+
     @staticmethod
     def __group_persons_by_normalized_name(persons_info: List[Work]) -> List[TextPersonInfo]:
-        # O(n^2) could be optimized?
+        # Only persons sharing a name token with the new one can be its subset or superset,
+        # persons without name tokens are subsets of everything
         text_persons = []
+        persons_by_token: Dict[str, List[int]] = defaultdict(list)
+        unnamed_persons: Set[int] = set()
         for person_info in persons_info:
             norm_tokens = set(person_info.person.norm_text.strip().split())
-            for text_person in text_persons:
-                larger, smaller = (norm_tokens, text_person.name_tokens) \
-                    if len(norm_tokens) > len(text_person.name_tokens) else (text_person.name_tokens, norm_tokens)
-                if smaller.issubset(larger):
-                    text_person.name_tokens = larger
-                    text_person.work.append(person_info)
-                    break
+            if norm_tokens:
+                common_tokens = Counter(i for token in norm_tokens for i in persons_by_token.get(token, ()))
+                matched = [i for i, common in common_tokens.items()
+                           if common == min(len(norm_tokens), len(text_persons[i].name_tokens))]
+                matched.extend(unnamed_persons)
             else:
+                matched = range(len(text_persons))
+            if not matched:
+                new_tokens, i = norm_tokens, len(text_persons)
                 text_persons.append(TextPersonInfo(norm_tokens, [person_info]))
+            else:
+                # The first created person wins, as with the sequential scan
+                i = min(matched)
+                text_person = text_persons[i]
+                new_tokens = norm_tokens - text_person.name_tokens
+                if len(norm_tokens) > len(text_person.name_tokens):
+                    text_person.name_tokens = norm_tokens
+                text_person.work.append(person_info)
+            for token in new_tokens:
+                persons_by_token[token].append(i)
+            if text_persons[i].name_tokens:
+                unnamed_persons.discard(i)
+            else:
+                unnamed_persons.add(i)
         return text_persons
 
     @staticmethod
@@ -42,18 +115,59 @@ class PersonInfoExtractor:
             names = sentence.calc_entities_by_type(EntityType.PER)
             if not names:
                 continue
+            names_index = TokenPositionIndex(names)
             sentence_persons_info = {name.norm_text: Work(name, [], []) for name in names}
             for time_ in sentence.calc_entities_by_type(EntityType.TIME):
-                time_match = parse_date_interval(time_.norm_text)
-                closest_person = time_.eval_closest_token(names)
+                time_match = _eval_time_match(time_)
+                closest_person = names_index.eval_closest_token(time_)
                 work = sentence_persons_info[closest_person.norm_text]
                 work.start_time = time_match.start_time if time_match else None
                 work.end_time = time_match.end_time if time_match else None
             for company in sentence.calc_entities_by_type(EntityType.ORG):
-                closest_person = company.eval_closest_token(names)
+                closest_person = names_index.eval_closest_token(company)
                 sentence_persons_info[closest_person.norm_text].companies.append(company)
             for job in sentence.calc_entities_by_type(EntityType.JOB):
-                closest_person = job.eval_closest_token(names)
+                closest_person = names_index.eval_closest_token(job)
                 sentence_persons_info[closest_person.norm_text].jobs.append(job)
             persons_info.extend(work for work in sentence_persons_info.values() if work.companies or work.jobs)
         return persons_info
+
+
+def _eval_time_match(time_: Token) -> Optional[TimeIntervalMatch]:
+    # The match found while tagging is reused when the entity covers it, else the entity text is parsed,
+    # as for matches crossing sentences or missing ones
+    match = time_.match
+    if match is not None and time_.norm_start_pos <= match.start and match.end <= time_.norm_end_pos:
+        return match
+    return parse_date_interval(time_.norm_text)
+
+
+def _shift_token(token: Token, offset: int) -> Token:
+    token = copy(token)
+    token.start_pos += offset
+    token.end_pos += offset
+    return token
+
+
+def _find_window_end(text: str, window_size: int) -> int:
+    # After the last sentence boundary of the window, else after its last whitespace
+    for separator in (SENTENCE_BOUNDARY, WHITESPACE):
+        end = max((match.end() for match in separator.finditer(text, 0, window_size)), default=0)
+        if end:
+            return end
+    return window_size
+
+
+_worker_extractor: Optional[PersonInfoExtractor] = None
+
+
+def _init_worker(recognizer: EntitiesRecognizer) -> None:
+    # Recognizers hold only their settings, the models are loaded once per worker
+    global _worker_extractor
+    _worker_extractor = PersonInfoExtractor(recognizer)
+
+
+def _extract_chunk(chunk: List[Tuple[str, str]]) -> Tuple[List[Tuple[str, List[TextPersonInfo]]], Dict[str, int]]:
+    # The recognizer counters are returned along, the parent one never sees the worker copies
+    results = [(source_id, _worker_extractor.extract(text)) for source_id, text in chunk]
+    return results, _worker_extractor.nlp.pop_counters()
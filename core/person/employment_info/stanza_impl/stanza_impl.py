@@ -1,49 +1,69 @@
 from __future__ import annotations
 
-from typing import List
+from functools import lru_cache
+from itertools import islice
+from typing import List, Iterable, Iterator
 
 import nltk
 import stanza
 from ahocorasick import Automaton
 
 from person.employment_info.domain import EntitiesRecognizer, Text, EntityType, Sentence, Token, normalize_text
-from person.employment_info.domain import TextMatch
-from person.employment_info.static import read_raw_job_titles
+from person.employment_info.domain import TextMatch, NormTextBuilder
+from person.employment_info.static import read_raw_job_titles, load_job_titles_artifact
 from person.employment_info.time_interval.time_interval_parser import parse_date_intervals
 
 
 class JobTitlesParserAhocorasick:
     def __init__(self):
+        self.ahocorasick = load_job_titles_artifact('stanza_job_titles', self.__build_automaton, 'nltk')
+
+    @staticmethod
+    def __build_automaton() -> Automaton:
         titles = read_raw_job_titles()
-        self.ahocorasick = Automaton()
+        ahocorasick = Automaton()
         for title in titles:
             title = normalize_text(title)
-            self.ahocorasick.add_word(title, title)
-            self.ahocorasick.add_word(title.lower(), title.lower())
-        self.ahocorasick.make_automaton()
+            ahocorasick.add_word(title, title)
+            ahocorasick.add_word(title.lower(), title.lower())
+        ahocorasick.make_automaton()
+        return ahocorasick
 
     def findall(self, norm_text: str) -> list[TextMatch]:
         return [TextMatch(match, end - len(match) + 1, end) for end, match in self.ahocorasick.iter(norm_text)]
 
 
 class StanzaEntitiesRecognizer(EntitiesRecognizer):
+    def __init__(self, offline: bool = False):
+        # Offline recognizers only use the already downloaded nltk data and stanza models
+        self.offline = offline
 
-    def __init__(self):
-        nltk.download('punkt')
-        nltk.download('averaged_perceptron_tagger')
-        nltk.download('maxent_ne_chunker')
-        nltk.download('words')
-        stanza.download('ru')
-        self.nlp = stanza.Pipeline(lang='ru', processors='tokenize,ner')
-        self.jobs_parser = JobTitlesParserAhocorasick()
+    @property
+    def nlp(self) -> stanza.Pipeline:
+        return load_pipeline(self.offline)
+
+    @property
+    def jobs_parser(self) -> JobTitlesParserAhocorasick:
+        return load_jobs_parser()
 
     def recognize_entities(self, text: str) -> Text:
-        norm_text, sentences = self.__recognize_named_entities_stanza(text)
+        return self.__recognize_entities(self.nlp(text))
+
+    def recognize_entities_batch(self, texts: Iterable[str], batch_size: int = 32) -> Iterator[Text]:
+        # The pipeline processes batch_size documents at once, sentences of all of them are batched together.
+        # A list of documents is processed with the bulk_process of the pipeline processors.
+        texts = iter(texts)
+        for batch in iter(lambda: list(islice(texts, batch_size)), []):
+            for document in self.nlp([stanza.Document([], text=text) for text in batch]):
+                yield self.__recognize_entities(document)
+
+    def __recognize_entities(self, document: stanza.Document) -> Text:
+        norm_text, sentences = self.__recognize_named_entities_stanza(document)
         self._set_entity(sentences, norm_text, self.jobs_parser.findall, EntityType.JOB)
         self._set_entity(sentences, norm_text, parse_date_intervals, EntityType.TIME)
-        return Text(text, norm_text, sentences)
+        return Text(document.text, norm_text, sentences)
 
-    def __recognize_named_entities_stanza(self, text: str) -> (str, List[Sentence]):
+    def __recognize_named_entities_stanza(self, document: stanza.Document) -> (str, List[Sentence]):
         def _eval_entity(token: stanza.models.common.doc.Token) -> EntityType:
             if 'ORG' in token.ner:
                 return EntityType.ORG
@@ -51,19 +71,40 @@ class StanzaEntitiesRecognizer(EntitiesRecognizer):
                 return EntityType.PER
             return EntityType.NONE
 
-        norm_text = ''
+        norm_text = NormTextBuilder()
         sentences = []
-        for sentence in self.nlp(text).sentences:
+        for sentence in document.sentences:
             tokens = []
             for token in sentence.tokens:
                 norm_token = normalize_text(token.text)
                 tokens.append(
                     Token(
                         token.text, token.start_char, token.end_char,
-                        norm_token, len(norm_text), len(norm_text) + len(norm_token),
+                        norm_token, norm_text.length, norm_text.length + len(norm_token),
                         _eval_entity(token)
                     )
                 )
-                norm_text += norm_token + ' '
+                norm_text.append(norm_token + ' ')
             sentences.append(Sentence(tokens))
-        return norm_text, sentences
+        return norm_text.build(), sentences
+
+
+##########
+# Models #
+##########
+
+@lru_cache(maxsize=None)
+def load_pipeline(offline: bool = False) -> stanza.Pipeline:
+    if offline:
+        return stanza.Pipeline(lang='ru', processors='tokenize,ner', download_method=None)
+    nltk.download('punkt')
+    nltk.download('averaged_perceptron_tagger')
+    nltk.download('maxent_ne_chunker')
+    nltk.download('words')
+    stanza.download('ru')
+    return stanza.Pipeline(lang='ru', processors='tokenize,ner')
+
+
+@lru_cache(maxsize=None)
+def load_jobs_parser() -> JobTitlesParserAhocorasick:
+    return JobTitlesParserAhocorasick()
@@ -1,9 +1,59 @@
-from importlib import resources
-from typing import Iterator
+import hashlib
+import os
+import pickle
+import tempfile
+from importlib import metadata, resources
+from pathlib import Path
+from typing import Iterator, Callable, TypeVar
+
+T = TypeVar('T')
+
+STATIC_PACKAGE = 'core.person.employment_info.static'
+JOB_TITLES_FILE = 'job_titles_dict.txt'
+
+ARTIFACTS_VERSION = 1
+ARTIFACTS_DIR = Path(
+    os.environ.get('EMPLOYMENT_INFO_CACHE_DIR', Path.home() / '.cache' / 'persons-employment-info-extractor')
+)
+MORPHOLOGY_DEPENDENCIES = ('pymorphy2', 'pymorphy2-dicts-ru')
 
 
 def read_raw_job_titles() -> Iterator[str]:
-    with resources.open_text('core.person.employment_info.static', 'job_titles_dict.txt') as dict_file:
+    with resources.open_text(STATIC_PACKAGE, JOB_TITLES_FILE) as dict_file:
         for line in dict_file:
             if line:
                 yield line.strip()
+
+
+def load_job_titles_artifact(name: str, build: Callable[[], T], *dependencies: str) -> T:
+    # Artifacts are keyed by the dictionary, the morphology and the given dependencies versions
+    key = hashlib.sha256(f'{name}:{ARTIFACTS_VERSION}'.encode())
+    key.update(resources.read_binary(STATIC_PACKAGE, JOB_TITLES_FILE))
+    for dependency in MORPHOLOGY_DEPENDENCIES + dependencies:
+        key.update(f'{dependency}=={metadata.version(dependency)}'.encode())
+    path = ARTIFACTS_DIR / f'{name}-{key.hexdigest()[:16]}.pickle'
+
+    try:
+        with path.open('rb') as artifact_file:
+            return pickle.load(artifact_file)
+    except Exception:
+        # Missing, truncated, or pickled with classes changed since without a version bump
+        pass
+
+    artifact = build()
+    artifact_file = None
+    try:
+        ARTIFACTS_DIR.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=ARTIFACTS_DIR, delete=False) as artifact_file:
+            pickle.dump(artifact, artifact_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(artifact_file.name, path)
+        for stale_path in ARTIFACTS_DIR.glob(f'{name}-*.pickle'):
+            if stale_path != path:
+                stale_path.unlink(missing_ok=True)
+    except OSError:
+        pass
+    finally:
+        # Left only if dump or replace failed
+        if artifact_file is not None:
+            Path(artifact_file.name).unlink(missing_ok=True)
+    return artifact
@@ -1,6 +1,25 @@
 # -*- coding: utf-8 -*-
 
+import random
+import re
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+from dataclasses import make_dataclass, fields
+from unittest.mock import patch
+
+import nltk
+import stanza
+from natasha import Doc
+
 from services import PersonInfoExtractor
+from person.employment_info.domain import NormTextBuilder, Token, Work, EntityType, TextPersonInfo, \
+    TokenPositionIndex
+from person.employment_info.natasha_impl.natasha_impl import NatashaEntitiesRecognizer
+from person.employment_info.cascade_impl.cascade_impl import CascadeEntitiesRecognizer
+from person.employment_info.stanza_impl.stanza_impl import StanzaEntitiesRecognizer, load_pipeline
 
 text = """
     В 1993 году Василий Абобович работал в компании NetCracker экономистом по сбыту.
@@ -35,7 +54,305 @@ text = """
 """
 
 
+def benchmark_job_titles_matching(number: int = 10) -> None:
+    nlp = NatashaEntitiesRecognizer()
+    sentences = [[token.norm_text for token in sentence.tokens] for sentence in nlp.recognize_entities(text).sentences]
+
+    def nested_loop():
+        tagged = set()
+        for i, tokens in enumerate(sentences):
+            for job_title in nlp.tokenized_norm_job_titles:
+                for start in range(len(tokens) - len(job_title) + 1):
+                    end = start + len(job_title)
+                    if job_title == tokens[start:end]:
+                        tagged.update((i, t) for t in range(start, end))
+        return tagged
+
+    def trie():
+        tagged = set()
+        for i, tokens in enumerate(sentences):
+            for match in nlp.jobs_parser.findall(tokens):
+                tagged.update((i, t) for t in range(match.start, match.end))
+        return tagged
+
+    assert nested_loop() == trie()
+    print(f'nested loop: {timeit.timeit(nested_loop, number=number) / number:.4f}s')
+    print(f'trie:        {timeit.timeit(trie, number=number) / number:.4f}s')
+
+
+def benchmark_span_lookup(number: int = 3) -> None:
+    names = ['Аркадий Волож', 'Илья Сегалович', 'Тигран Худавердян', 'Дмитрий Медведев', 'Игорь Абраменко']
+    board = ', '.join(f'{name} ({i})' for i in range(200) for name in names)
+    nlp = NatashaEntitiesRecognizer()
+    doc = Doc(f'В совет директоров компании Яндекс вошли {board}.')
+    doc.segment(nlp.segmenter)
+    doc.tag_ner(nlp.ner_tagger)
+
+    def span_scan():
+        entities = []
+        for sent in doc.sents:
+            for token in sent.tokens:
+                entities.append(next((span.type for span in sent.spans for t in span.tokens if t is token), None))
+        return entities
+
+    def span_index():
+        index = nlp._NatashaEntitiesRecognizer__eval_entities(doc)
+        return [index.get(id(token)) for sent in doc.sents for token in sent.tokens]
+
+    assert span_scan() == span_index()
+    print(f'{len(doc.tokens)} tokens, {len(doc.spans)} spans')
+    print(f'span scan:  {timeit.timeit(span_scan, number=number) / number:.4f}s')
+    print(f'span index: {timeit.timeit(span_index, number=number) / number:.4f}s')
+
+
+def benchmark_norm_text_building(size: int = 5 * 2 ** 20, compare: bool = True) -> None:
+    document = text * (size // len(text) + 1)
+    sentences = [sentence.split() for sentence in document.split('.')]
+
+    def concatenation():
+        norm_text = ''
+        for sentence in sentences:
+            for token in sentence:
+                norm_text += token.strip() + ' '
+            norm_text = norm_text.strip() + '.'
+        return norm_text
+
+    def builder():
+        norm_text = NormTextBuilder()
+        for sentence in sentences:
+            for token in sentence:
+                norm_text.append(token.strip() + ' ')
+            norm_text.strip()
+            norm_text.append('.')
+        return norm_text.build()
+
+    start = time.perf_counter()
+    norm_text = builder()
+    print(f'{len(document) / 2 ** 20:.1f} MB norm text builder: {time.perf_counter() - start:.4f}s')
+    if not compare:
+        return
+    start = time.perf_counter()
+    assert concatenation() == norm_text
+    print(f'{len(document) / 2 ** 20:.1f} MB norm text concatenation: {time.perf_counter() - start:.4f}s')
+
+
+def benchmark_persons_grouping(persons: int = 3000, number: int = 3) -> None:
+    rand = random.Random(0)
+    first_names = [f'имя{i}' for i in range(persons // 10)]
+    surnames = [f'фамилия{i}' for i in range(persons // 2)]
+    names = [
+        rand.choice([f'{rand.choice(first_names)} {surname}', surname, f'{surname} {rand.choice(first_names)}', ''])
+        for surname in rand.choices(surnames, k=persons)
+    ]
+
+    def works():
+        return [Work(Token(name, 0, 0, name, 0, 0, EntityType.PER), [], []) for name in names]
+
+    def sequential_scan(persons_info):
+        text_persons = []
+        for person_info in persons_info:
+            norm_tokens = set(person_info.person.norm_text.strip().split())
+            for text_person in text_persons:
+                larger, smaller = (norm_tokens, text_person.name_tokens) \
+                    if len(norm_tokens) > len(text_person.name_tokens) else (text_person.name_tokens, norm_tokens)
+                if smaller.issubset(larger):
+                    text_person.name_tokens = larger
+                    text_person.work.append(person_info)
+                    break
+            else:
+                text_persons.append(TextPersonInfo(norm_tokens, [person_info]))
+        return text_persons
+
+    inverted_index = PersonInfoExtractor._PersonInfoExtractor__group_persons_by_normalized_name
+    assert sequential_scan(works()) == inverted_index(works())
+    # An unnamed person absorbs all the later ones, so the timing is measured without them
+    names = [name for name in names if name]
+    assert sequential_scan(works()) == inverted_index(works())
+    print(f'{len(names)} persons')
+    print(f'sequential scan: {timeit.timeit(lambda: sequential_scan(works()), number=number) / number:.4f}s')
+    print(f'inverted index:  {timeit.timeit(lambda: inverted_index(works()), number=number) / number:.4f}s')
+
+
+def test_cascade_recall() -> None:
+    nlp = NatashaEntitiesRecognizer()
+    doc = Doc(text)
+    doc.segment(nlp.segmenter)
+    documents = [sent.text for sent in doc.sents] + [text, 'Сегодня в городе солнечно.', 'погода хорошая']
+    cascade = CascadeEntitiesRecognizer(nlp)
+    extractor, cascade_extractor = PersonInfoExtractor(nlp), PersonInfoExtractor(cascade)
+    for document in documents:
+        assert repr(extractor.extract(document)) == repr(cascade_extractor.extract(document)), document
+    # The worker processes counters are added to the parent recognizer
+    bulk_cascade = CascadeEntitiesRecognizer(nlp)
+    list(PersonInfoExtractor(bulk_cascade).extract_many(enumerate(documents), workers=2))
+    assert (bulk_cascade.recognized, bulk_cascade.skipped) == (cascade.recognized, cascade.skipped)
+    print(f'cascade recall: ok, {cascade.skipped} of {len(documents)} documents skipped')
+
+
+def test_stanza_batch_recognition() -> None:
+    class FakePipeline:
+        # Whitespace tokens of one sentence per line, capitalized ones are persons
+        def __init__(self, **kwargs):
+            self.kwargs = kwargs
+
+        def __call__(self, doc):
+            if isinstance(doc, list):
+                return [self(document) for document in doc]
+            text = doc.text if isinstance(doc, stanza.Document) else doc
+            sentences = []
+            for line in re.finditer(r'[^\n]+', text):
+                sentences.append([
+                    {
+                        'id': (i,), 'text': word.group(), 'start_char': line.start() + word.start(),
+                        'end_char': line.start() + word.end(), 'ner': 'S-PER' if word.group()[0].isupper() else 'O'
+                    }
+                    for i, word in enumerate(re.finditer(r'\S+', line.group()), 1)
+                ])
+            return stanza.Document(sentences, text=text)
+
+    texts = [
+        'Аркадий Волож основал фирму CompTek в 1989 году',
+        'в 1993 году\nИлья Сегалович работал директором по технологиям',
+        'погода хорошая',
+    ]
+    load_pipeline.cache_clear()
+    try:
+        with patch.object(stanza, 'Pipeline', FakePipeline), patch.object(stanza, 'download') as stanza_download, \
+                patch.object(nltk, 'download') as nltk_download:
+            nlp = StanzaEntitiesRecognizer(offline=True)
+            batch = list(nlp.recognize_entities_batch(texts, batch_size=2))
+            assert repr(batch) == repr([nlp.recognize_entities(text) for text in texts])
+            for text, recognized in zip(texts, batch):
+                assert recognized.text == text
+                for sentence in recognized.sentences:
+                    for token in sentence.tokens:
+                        assert text[token.start_pos:token.end_pos] == token.text
+            assert nlp.nlp.kwargs['download_method'] is None
+            stanza_download.assert_not_called()
+            nltk_download.assert_not_called()
+    finally:
+        load_pipeline.cache_clear()
+    print('stanza batch recognition: ok')
+
+
+def test_closest_token(number: int = 1000) -> None:
+    rand = random.Random(0)
+
+    def token(start, end):
+        return Token('', start, end, '', start, end, EntityType.PER)
+
+    for _ in range(number):
+        starts = sorted(rand.sample(range(100), rand.randint(2, 20)))
+        names = [token(start, rand.randint(start + 1, end)) for start, end in zip(starts, starts[1:])]
+        # Overlapping and unordered names fall back to the scan
+        if rand.random() < 0.2:
+            names.append(token(rand.randint(0, 90), rand.randint(91, 100)))
+        index = TokenPositionIndex(names)
+        for start in range(-5, 105):
+            entity = token(start, start + rand.randint(1, 5))
+            assert index.eval_closest_token(entity) is entity.eval_closest_token(names)
+    print('closest token: ok')
+
+
+def benchmark_closest_token(persons: int = 100, entities: int = 1000, number: int = 10) -> None:
+    names = [Token('', i * 10, i * 10 + 5, '', 0, 0, EntityType.PER) for i in range(persons)]
+    others = [Token('', i * 7, i * 7 + 3, '', 0, 0, EntityType.ORG) for i in range(entities)]
+
+    def scan():
+        return [entity.eval_closest_token(names) for entity in others]
+
+    def bisect():
+        index = TokenPositionIndex(names)
+        return [index.eval_closest_token(entity) for entity in others]
+
+    assert scan() == bisect()
+    print(f'{persons} persons, {entities} entities')
+    print(f'closest token scan:   {timeit.timeit(scan, number=number) / number:.4f}s')
+    print(f'closest token bisect: {timeit.timeit(bisect, number=number) / number:.4f}s')
+
+
+def benchmark_token_memory(count: int = 10 ** 5) -> None:
+    # The same dataclass without slots, as Token used to be
+    DictToken = make_dataclass('DictToken', [(f.name, f.type) for f in fields(Token)])
+
+    for token_type in (DictToken, Token):
+        tracemalloc.start()
+        tokens = [token_type('токен', i, i + 5, 'токен', i, i + 5, EntityType.NONE) for i in range(count)]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{token_type.__name__}: {size / len(tokens):.0f} bytes per token')
+
+
+def benchmark_stream_memory(sizes=(2 ** 15, 2 ** 17), window_size: int = 2 ** 13) -> None:
+    extractor = PersonInfoExtractor()
+    # The models are loaded outside of the traced allocations
+    extractor.extract(text)
+
+    def chunks(size):
+        for _ in range(size // len(text)):
+            yield text
+
+    for size in sizes:
+        tracemalloc.start()
+        works = sum(1 for _ in extractor.extract_stream(chunks(size), window_size))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{size / 2 ** 20:.2f} MB stream: {works} works, peak {peak / 2 ** 20:.1f} MB')
+    tracemalloc.start()
+    persons = extractor.extract(''.join(chunks(sizes[0])))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{sizes[0] / 2 ** 20:.2f} MB extract: {len(persons)} persons, peak {peak / 2 ** 20:.1f} MB')
+
+
+def benchmark_batch_recognition(copies: int = 8, batch_size: int = 32) -> None:
+    nlp = NatashaEntitiesRecognizer()
+    documents = [line.strip() for line in text.splitlines() if line.strip()] * copies
+    nlp.recognize_entities(text)
+
+    start = time.perf_counter()
+    single = [nlp.recognize_entities(document) for document in documents]
+    single_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    batch = list(nlp.recognize_entities_batch(documents, batch_size))
+    batch_elapsed = time.perf_counter() - start
+    assert repr(single) == repr(batch)
+    print(f'recognize_entities:       {len(documents) / single_elapsed:.1f} documents/s')
+    print(f'recognize_entities_batch: {len(documents) / batch_elapsed:.1f} documents/s')
+
+
+def benchmark_startup() -> None:
+    # Fresh interpreter, so that nothing is imported or loaded yet
+    code = '''
+import time
+start = time.perf_counter()
+from person.employment_info.services import PersonInfoExtractor
+imported = time.perf_counter()
+PersonInfoExtractor().extract('В 1993 году Василий Абобович работал в компании NetCracker экономистом.')
+extracted = time.perf_counter()
+print(f'import services:  {imported - start:.4f}s')
+print(f'first extraction: {extracted - imported:.4f}s')
+'''
+    subprocess.run([sys.executable, '-c', code], check=True)
+
+
 if __name__ == '__main__':
+    if 'benchmark' in sys.argv[1:]:
+        benchmark_job_titles_matching()
+        benchmark_span_lookup()
+        # The concatenation is quadratic, about 150s on 5 MB
+        benchmark_norm_text_building(2 ** 20)
+        benchmark_norm_text_building(5 * 2 ** 20, compare=False)
+        benchmark_persons_grouping()
+        test_closest_token()
+        benchmark_closest_token()
+        benchmark_token_memory()
+        benchmark_stream_memory()
+        benchmark_batch_recognition()
+        benchmark_startup()
+        sys.exit()
+    test_cascade_recall()
+    test_stanza_batch_recognition()
     person_info_extractor = PersonInfoExtractor()
     text_persons = person_info_extractor.extract(text)
     for person in text_persons:
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import sys
+import timeit
+
 from yargy import rule, and_, or_, Parser
 from yargy.interpretation import fact
 from yargy.predicates import (
@@ -9,6 +12,9 @@ from yargy.predicates import (
     in_
 )
 
+from person.employment_info.time_interval.time_interval_parser import parser, parse_date_intervals, \
+    TimeIntervalMatch, date_cache_info, _parse_window
+
 
 Date = fact(
     'Date',
@@ -64,7 +70,45 @@ date_rule = or_(
 
 # parser = Parser(date_rule)
 
+
+def parse_date_intervals_full(text: str) -> list[TimeIntervalMatch]:
+    # parse_date_intervals without the year windows
+    intervals = []
+    for match in parser.findall(text):
+        start, end = match.tokens[0].span.start, match.tokens[-1].span.stop
+        intervals.append(TimeIntervalMatch(text[start:end], start, end, match.fact))
+    return intervals
+
+
+def benchmark_year_windows(number: int = 3) -> None:
+    dates = 'с 18 июня 2016 по июль 2018 года Иван работал в компании, 12.05.1999 — 2003 г. он переехал. '
+    prose = 'Компания разработала собственную технологию прогноза погоды для своих сервисов. '
+    for name, text in (('dense', dates * 100), ('sparse', (dates + prose * 50) * 4)):
+        assert repr(parse_date_intervals_full(text)) == repr(parse_date_intervals(text))
+        full = timeit.timeit(lambda: parse_date_intervals_full(text), number=number) / number
+        # Without the date cache, each run parses all the windows
+        windows = timeit.timeit(
+            lambda: (_parse_window.cache_clear(), parse_date_intervals(text)), number=number
+        ) / number
+        print(f'{name} {len(text)} chars: whole text {full:.4f}s, year windows {windows:.4f}s')
+
+
+def benchmark_date_cache(documents: int = 200) -> None:
+    dates = ['с 1992 по 2003 год', 'апрель 2000', '23 сентября 1997', 'с июня 2017 до июля 2018', '1989']
+    texts = [f'{dates[i % len(dates)]} работал в компании' for i in range(documents)]
+    _parse_window.cache_clear()
+    cached = timeit.timeit(lambda: [parse_date_intervals(text) for text in texts], number=1)
+    info = date_cache_info()
+    print(f'{documents} documents, cached: {cached:.4f}s, hit rate {info.hits / (info.hits + info.misses):.2f}')
+    uncached = timeit.timeit(lambda: [parse_date_intervals_full(text) for text in texts], number=1)
+    print(f'{documents} documents, uncached: {uncached:.4f}s')
+
+
 if __name__ == '__main__':
+    if 'benchmark' in sys.argv[1:]:
+        benchmark_year_windows()
+        benchmark_date_cache()
+        sys.exit()
     text = '''
 18 июня 2016
 18 06  2016
@@ -1,7 +1,9 @@
 from dataclasses import dataclass
-from typing import Optional
+from functools import lru_cache
+from typing import Optional, Tuple
 
 from yargy import Parser, rule, and_, or_
+from yargy.tokenizer import Tokenizer, INT
 from yargy.interpretation import fact
 from yargy.predicates import (
     lte,
@@ -70,6 +72,13 @@ interval_rule = rule(
 
 parser = Parser(interval_rule)
 
+# Every interval has a year and at most 7 + 1 + 6 tokens, so it lies within that many tokens of its year
+MAX_INTERVAL_TOKENS = 14
+tokenizer = Tokenizer()
+
+# Windows are mostly short date phrases repeated across documents
+DATE_CACHE_SIZE = 2 ** 14
+
 
 @dataclass
 class TimeIntervalMatch(TextMatch):
@@ -87,13 +96,48 @@ class TimeIntervalMatch(TextMatch):
 
 
 def parse_date_intervals(text: str) -> list[TimeIntervalMatch]:
+    # The parser runs only on the windows around years, matches never cross windows,
+    # so the overlapping matches are resolved per window the same way as for the whole text
     intervals = []
-    for match in parser.findall(text):
-        start, end = match.tokens[0].span.start, match.tokens[-1].span.stop
-        intervals.append(TimeIntervalMatch(text[start:end], start, end, match.fact))
+    for window_start, window_end in _eval_year_windows(text):
+        for start, end, interval in _parse_window(text[window_start:window_end]):
+            start, end = window_start + start, window_start + end
+            intervals.append(TimeIntervalMatch(text[start:end], start, end, Interval(**dict(interval))))
     return intervals
 
 
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def _parse_window(window: str) -> Tuple[Tuple[int, int, Tuple[Tuple[str, Optional[int]], ...]], ...]:
+    # Immutable matches, the caller builds its own facts from them
+    return tuple(
+        (
+            match.tokens[0].span.start, match.tokens[-1].span.stop,
+            tuple((attribute, getattr(match.fact, attribute)) for attribute in Interval.__attributes__)
+        )
+        for match in parser.findall(window)
+    )
+
+
+def date_cache_info() -> tuple:
+    # Shared by all threads, functools caches are thread safe
+    return _parse_window.cache_info()
+
+
+def _eval_year_windows(text: str) -> list[tuple[int, int]]:
+    tokens = list(tokenizer(text))
+    windows = []
+    for i, token in enumerate(tokens):
+        if token.type != INT or not YEAR(token):
+            continue
+        start = max(i - MAX_INTERVAL_TOKENS + 1, 0)
+        end = min(i + MAX_INTERVAL_TOKENS - 1, len(tokens) - 1)
+        if windows and start <= windows[-1][1]:
+            windows[-1][1] = end
+        else:
+            windows.append([start, end])
+    return [(tokens[start].span.start, tokens[end].span.stop) for start, end in windows]
+
+
 def parse_date_interval(text: str) -> Optional[TimeIntervalMatch]:
     intervals = parse_date_intervals(text)
     if intervals:
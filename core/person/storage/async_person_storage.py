@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import asyncio
+from abc import ABC, abstractmethod
+from concurrent.futures import Executor
+from itertools import islice
+from typing import List, Iterable, Tuple, Dict, Optional, TYPE_CHECKING
+
+import asyncpg
+
+from person.employment_info.domain import TextPersonInfo
+from person.storage.name_id_cache import NameIdCache, CacheInfo
+from person.storage.person_storage import NAME_TABLES, CREATE_TABLES, UPSERT_NAMES, INSERT_WORKS, eval_names, \
+    eval_work_rows
+
+if TYPE_CHECKING:
+    from person.employment_info.services import PersonInfoExtractor
+
+
+class AsyncPersonStorage(ABC):
+    @abstractmethod
+    async def push_person_info(self, info: List[TextPersonInfo], source_id: str) -> None:
+        pass
+
+    async def push_person_info_many(self, infos: Iterable[Tuple[str, List[TextPersonInfo]]]) -> None:
+        for source_id, info in infos:
+            await self.push_person_info(info, source_id)
+
+    async def push_extracted(self, extractor: PersonInfoExtractor, texts: Iterable[Tuple[str, str]],
+                             executor: Optional[Executor] = None, batch_size: int = 64) -> None:
+        # Extraction of the next batch runs in the executor while the previous batch is being pushed,
+        # the texts of a batch are extracted concurrently
+        loop = asyncio.get_running_loop()
+        texts = iter(texts)
+        push = None
+        try:
+            for batch in iter(lambda: list(islice(texts, batch_size)), []):
+                infos = await asyncio.gather(
+                    *(loop.run_in_executor(executor, extractor.extract, text) for _, text in batch)
+                )
+                if push:
+                    await push
+                push = asyncio.create_task(
+                    self.push_person_info_many([(source_id, info) for (source_id, _), info in zip(batch, infos)])
+                )
+            if push:
+                await push
+        finally:
+            if push and not push.done():
+                # The pushed batch is committed or not before an extraction error is raised
+                await asyncio.gather(push, return_exceptions=True)
+
+
+class AsyncPersonStoragePostgres(AsyncPersonStorage):
+
+    def __init__(self, pool: asyncpg.Pool, cache_size: int = 2 ** 16):
+        # Persons are deduplicated by the exact normalized name only, a PersonIndex is not supported
+        self.pool = pool
+        self.name_id_caches = {table: NameIdCache(cache_size) for table in NAME_TABLES}
+
+    @classmethod
+    async def connect(cls, database: str, user: str, password: str, host: str = '127.0.0.1', port: int = 5432,
+                      min_connections: int = 1, max_connections: int = 8,
+                      cache_size: int = 2 ** 16) -> AsyncPersonStoragePostgres:
+        pool = await asyncpg.create_pool(
+            database=database, user=user, password=password, host=host, port=port,
+            min_size=min_connections, max_size=max_connections
+        )
+        async with pool.acquire() as conn:
+            for create_table in CREATE_TABLES:
+                await conn.execute(create_table)
+        return cls(pool, cache_size)
+
+    async def close(self) -> None:
+        await self.pool.close()
+
+    async def __aenter__(self) -> AsyncPersonStoragePostgres:
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    def cache_info(self) -> Dict[str, CacheInfo]:
+        return {table: cache.cache_info() for table, cache in self.name_id_caches.items()}
+
+    async def push_person_info(self, info: List[TextPersonInfo], source_id: str) -> None:
+        await self.push_person_info_many([(source_id, info)])
+
+    async def push_person_info_many(self, infos: Iterable[Tuple[str, List[TextPersonInfo]]]) -> None:
+        infos = list(infos)
+        person_names, job_names, company_names = eval_names(infos)
+        async with self.pool.acquire() as conn, conn.transaction():
+            person_ids = await self.__upsert_names(conn, 'Person', person_names)
+            job_ids = await self.__upsert_names(conn, 'Job', job_names)
+            company_ids = await self.__upsert_names(conn, 'Company', company_names)
+            works = eval_work_rows(infos, person_ids, job_ids, company_ids)
+            if works:
+                await conn.execute(INSERT_WORKS, *(list(column) for column in zip(*works)))
+        # Only committed ids may be cached
+        self.name_id_caches['Person'].put_many(person_ids)
+        self.name_id_caches['Job'].put_many(job_ids)
+        self.name_id_caches['Company'].put_many(company_ids)
+
+    async def __upsert_names(self, conn: asyncpg.Connection, table: str, names: Iterable[str]) -> Dict[str, int]:
+        ids, missing = self.name_id_caches[table].get_many(names)
+        if missing:
+            # asyncpg prepares and caches the statement per connection
+            ids.update(await conn.fetch(UPSERT_NAMES.format(table=table), sorted(missing)))
+        return ids
@@ -0,0 +1,39 @@
+import threading
+from collections import OrderedDict, namedtuple
+from typing import Dict, Iterable, List, Tuple
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class NameIdCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.__ids: OrderedDict[str, int] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get_many(self, names: Iterable[str]) -> Tuple[Dict[str, int], List[str]]:
+        found, missing = {}, []
+        with self.__lock:
+            for name in names:
+                id_ = self.__ids.get(name)
+                if id_ is None:
+                    missing.append(name)
+                else:
+                    self.__ids.move_to_end(name)
+                    found[name] = id_
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def put_many(self, ids: Dict[str, int]) -> None:
+        with self.__lock:
+            for name, id_ in ids.items():
+                self.__ids[name] = id_
+                self.__ids.move_to_end(name)
+            while len(self.__ids) > self.maxsize:
+                self.__ids.popitem(last=False)
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.__ids))
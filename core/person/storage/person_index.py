@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import defaultdict, Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import psycopg2
+
+CREATE_TABLES = (
+    """
+    create table if not exists PersonNameToken (
+        token text not null,
+        person integer not null,
+        primary key (token, person)
+    )
+    """,
+    """
+    create index if not exists PersonNameToken_person on PersonNameToken (person)
+    """,
+)
+
+# Shared and total name tokens of every person sharing at least one token with a name
+SELECT_CANDIDATES = """
+    with name_tokens (name, token) as ({name_tokens}),
+    candidates as (
+        select distinct name_tokens.name, name_index.person
+        from name_tokens join PersonNameToken as name_index on name_index.token = name_tokens.token
+    )
+    select candidates.name, candidates.person, count(name_tokens.token), count(*)
+    from candidates
+    join PersonNameToken as person_tokens on person_tokens.person = candidates.person
+    left join name_tokens on name_tokens.name = candidates.name and name_tokens.token = person_tokens.token
+    group by candidates.name, candidates.person
+    """
+
+
+class PersonIndex(ABC):
+    """
+    Name token -> person ids index, resolving names to the already stored persons. A name resolves
+    to the only person whose name tokens are a subset or a superset of its own ones, the same way
+    persons are grouped within one text, so a surname alone resolves to the full name and vice versa.
+    A name matching several persons, as a first name or a surname shared by relatives, is left unresolved.
+    Only the persons pushed with the index are indexed, the earlier ones are added by
+    PersonStoragePostgres.index_persons. AsyncPersonStoragePostgres takes no index and keeps
+    deduplicating persons by the exact normalized name, so it may store one person as several.
+    """
+
+    def resolve_many(self, names: Iterable[str]) -> Dict[str, int]:
+        names = [name for name in names if eval_name_tokens(name)]
+        resolved = {}
+        for name, candidates in self._eval_candidates(names).items():
+            person = eval_matched_person(eval_name_tokens(name), candidates)
+            if person is not None:
+                resolved[name] = person
+        return resolved
+
+    @abstractmethod
+    def _eval_candidates(self, names: List[str]) -> Dict[str, Dict[int, Tuple[int, int]]]:
+        # name -> {person: (shared tokens, person tokens)}
+        pass
+
+    @abstractmethod
+    def add_many(self, ids: Dict[str, int]) -> None:
+        # Name tokens are added to the person ones, so persons grow as in the text grouping
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> PersonIndex:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class PersonIndexPostgres(PersonIndex):
+
+    def __init__(self, database: str, user: str, password: str, host: str = '127.0.0.1', port: int = 5432):
+        self.conn = psycopg2.connect(database=database, user=user, password=password, host=host, port=port)
+        self.__lock = threading.Lock()
+        with self.conn, self.conn.cursor() as cur:
+            for create_table in CREATE_TABLES:
+                cur.execute(create_table)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _eval_candidates(self, names: List[str]) -> Dict[str, Dict[int, Tuple[int, int]]]:
+        if not names:
+            return {}
+        name_tokens = eval_name_token_rows(names)
+        with self.__lock, self.conn, self.conn.cursor() as cur:
+            cur.execute(
+                SELECT_CANDIDATES.format(name_tokens='select * from unnest(%s::text[], %s::text[])'),
+                [list(column) for column in zip(*name_tokens)]
+            )
+            return eval_candidates_by_name(cur.fetchall())
+
+    def add_many(self, ids: Dict[str, int]) -> None:
+        rows = [(token, person) for name, person in ids.items() for token in eval_name_tokens(name)]
+        if not rows:
+            return
+        with self.__lock, self.conn, self.conn.cursor() as cur:
+            cur.execute(
+                """
+                insert into PersonNameToken (token, person) select * from unnest(%s::text[], %s::integer[])
+                on conflict do nothing
+                """,
+                [list(column) for column in zip(*rows)]
+            )
+
+
+class PersonIndexSqlite(PersonIndex):
+    """ Embedded index for the person ids of any storage, kept in a sqlite database file """
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.__lock = threading.Lock()
+        with self.__lock, self.conn:
+            for create_table in CREATE_TABLES:
+                self.conn.execute(create_table)
+            self.conn.execute('create temp table NameToken (name text not null, token text not null)')
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _eval_candidates(self, names: List[str]) -> Dict[str, Dict[int, Tuple[int, int]]]:
+        if not names:
+            return {}
+        with self.__lock, self.conn:
+            self.conn.execute('delete from NameToken')
+            self.conn.executemany('insert into NameToken (name, token) values (?, ?)', eval_name_token_rows(names))
+            rows = self.conn.execute(SELECT_CANDIDATES.format(name_tokens='select name, token from NameToken'))
+            return eval_candidates_by_name(rows.fetchall())
+
+    def add_many(self, ids: Dict[str, int]) -> None:
+        rows = [(token, person) for name, person in ids.items() for token in eval_name_tokens(name)]
+        with self.__lock, self.conn:
+            self.conn.executemany('insert or ignore into PersonNameToken (token, person) values (?, ?)', rows)
+
+
+def eval_name_tokens(name: str) -> Set[str]:
+    return set(name.split())
+
+
+def eval_name_token_rows(names: Iterable[str]) -> List[Tuple[str, str]]:
+    return [(name, token) for name in names for token in eval_name_tokens(name)]
+
+
+def eval_candidates_by_name(rows: Iterable[Tuple[str, int, int, int]]) -> Dict[str, Dict[int, Tuple[int, int]]]:
+    candidates = defaultdict(dict)
+    for name, person, common, size in rows:
+        candidates[name][person] = (common, size)
+    return candidates
+
+
+def eval_matched_person(tokens: Set[str], candidates: Dict[int, Tuple[int, int]]) -> Optional[int]:
+    # All the tokens of the smaller name are shared, the person with the same tokens wins
+    matched = [person for person, (common, size) in candidates.items() if common == min(len(tokens), size)]
+    same = [person for person in matched if candidates[person] == (len(tokens), len(tokens))]
+    if same:
+        return min(same)
+    return matched[0] if len(matched) == 1 else None
+
+
+def group_names(names: Iterable[str]) -> Dict[str, str]:
+    # Each name is grouped under the only longer name containing all its tokens,
+    # for the new names of one batch which are not indexed yet
+    groups = {}
+    representatives = []
+    representatives_by_token = defaultdict(list)
+    for name in sorted(names, key=lambda name: (-len(eval_name_tokens(name)), name)):
+        tokens = eval_name_tokens(name)
+        common = Counter(i for token in tokens for i in representatives_by_token.get(token, ()))
+        matched = [i for i, count in common.items() if count == len(tokens)]
+        if len(matched) == 1:
+            groups[name] = representatives[matched[0]]
+            continue
+        for token in tokens:
+            representatives_by_token[token].append(len(representatives))
+        representatives.append(name)
+        groups[name] = name
+    return groups
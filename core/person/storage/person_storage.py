@@ -1,133 +1,260 @@
+from __future__ import annotations
+
+import threading
+import time
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from itertools import product
-from string import Template
-from typing import List
+from typing import List, Iterable, Tuple, Dict, Callable, TypeVar, Iterator, Optional
 
 import psycopg2
+from psycopg2.extensions import connection, cursor
+from psycopg2.pool import ThreadedConnectionPool
 
 from person.employment_info.domain import TextPersonInfo
+from person.storage.name_id_cache import NameIdCache, CacheInfo
+from person.storage.person_index import PersonIndex, group_names
+
+T = TypeVar('T')
+
+NAME_TABLES = ('Person', 'Company', 'Job')
+
+CREATE_TABLES = (
+    """
+    create table if not exists Person (
+        id serial primary key,
+        norm_name text not null,
+        unique (norm_name)
+    )
+    """,
+    """
+    create table if not exists Company (
+        id serial primary key,
+        norm_name text not null,
+        unique (norm_name)
+    )
+    """,
+    """
+    create table if not exists Job (
+        id serial primary key,
+        norm_name text not null,
+        unique (norm_name)
+    )
+    """,
+    """
+    create table if not exists Work (
+        id serial primary key,
+        person integer references Person,
+        company integer references Company,
+        job integer references Job,
+        start_year integer,
+        start_month integer,
+        end_year integer,
+        end_month integer,
+        source_id varchar(100),
+        unique(person, company, job, start_year, start_month, end_year, end_month, source_id)
+    )
+    """,
+)
+
+UPSERT_NAMES = """
+    insert into {table} (norm_name) select unnest($1::text[])
+    on conflict (norm_name) do update set norm_name = excluded.norm_name
+    returning norm_name, id
+    """
+
+INSERT_WORKS_TYPES = ('integer[]',) * 7 + ('varchar[]',)
+INSERT_WORKS = """
+    insert into Work (person, company, job, start_year, start_month, end_year, end_month, source_id)
+    select * from unnest($1::integer[], $2::integer[], $3::integer[], $4::integer[], $5::integer[], $6::integer[],
+                         $7::integer[], $8::varchar[])
+    on conflict do nothing
+    """
 
 
 class PersonStorage(ABC):
     @abstractmethod
-    def push_person_info(self, info: TextPersonInfo, source_id: str) -> None:
+    def push_person_info(self, info: List[TextPersonInfo], source_id: str) -> None:
         pass
 
+    def push_person_info_many(self, infos: Iterable[Tuple[str, List[TextPersonInfo]]]) -> None:
+        for source_id, info in infos:
+            self.push_person_info(info, source_id)
+
+
 class PersonStoragePostgres(PersonStorage):
 
-    NULL = 'null'
-
-    def __init__(self, database: str, user: str, password: str, host: str = '127.0.0.1', port: int = 5432):
-        self.conn = psycopg2.connect(database=database, user=user, password=password, host=host, port=port)
-        self.cur = self.conn.cursor()
-        self.__prepare()
-
-    def __del__(self):
-        self.conn.close()
-        self.cur.close()
-
-    def __prepare(self):
-        create_person_table = """
-        create table if not exists Person (
-            id serial primary key,
-            norm_name text not null,
-            unique (norm_name)
-        );
-        """
-        create_company_table = """
-        create table if not exists Company (
-            id serial primary key,
-            norm_name text not null,
-            unique (norm_name)
-        )        
-        """
-        create_job_table = """
-        create table if not exists Job (
-            id serial primary key,
-            norm_name text not null,
-            unique (norm_name)
-        )        
-        """
-        create_work_table = """
-        create table if not exists Work (
-            id serial primary key,
-            person integer references Person,
-            company integer references Company,
-            job integer references Job,
-            start_year integer,
-            start_month integer,
-            end_year integer,
-            end_month integer,
-            source_id varchar(100),
-            unique(person, company, job, start_year, start_month, end_year, end_month, source_id)
-        )        
-        """
-        self.cur.execute(create_person_table)
-        self.cur.execute(create_company_table)
-        self.cur.execute(create_job_table)
-        self.cur.execute(create_work_table)
-        self.conn.commit()
+    TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
 
-    def push_person_info(self, info: List[TextPersonInfo], source_id: str) -> None:
-        insert_person = Template(
-            """
-            insert into Person (norm_name) values ('${norm_name}') on conflict do nothing
-            """
-        )
-        insert_company = Template(
-            """
-            insert into Company (norm_name) values ('${norm_name}') on conflict do nothing
-            """
-        )
-        insert_job = Template(
-            """
-            insert into Job (norm_name) values ('${norm_name}') on conflict do nothing
-            """
-        )
-        insert_work = Template(
-            """
-            insert into Work (person, company, job, start_year, start_month, end_year, end_month, source_id) 
-            values (
-                ${person}, ${company}, ${job}, ${start_year}, ${start_month}, ${end_year}, ${end_month}, '${source_id}'
-            ) 
-            on conflict do nothing
-            """
+    def __init__(self, database: str, user: str, password: str, host: str = '127.0.0.1', port: int = 5432,
+                 cache_size: int = 2 ** 16, prewarm_cache: bool = False, min_connections: Optional[int] = None,
+                 max_connections: int = 8, retries: int = 3, retry_delay: float = 0.1,
+                 person_index: Optional[PersonIndex] = None):
+        # The pool closes the connections returned beyond min_connections, losing their prepared statements
+        min_connections = max_connections if min_connections is None else min_connections
+        self.pool = ThreadedConnectionPool(
+            min_connections, max_connections, database=database, user=user, password=password, host=host, port=port
         )
+        self.retries = retries
+        self.retry_delay = retry_delay
+        # Without the index persons are deduplicated by the exact normalized name only
+        self.person_index = person_index
+        # The pool raises instead of waiting when it is exhausted
+        self.__available_connections = threading.BoundedSemaphore(max_connections)
+        self.name_id_caches = {table: NameIdCache(cache_size) for table in NAME_TABLES}
+        self.__prepared_connections = set()
+        conn = self.pool.getconn()
+        try:
+            with conn, conn.cursor() as cur:
+                self.__prepare(cur)
+        finally:
+            self.pool.putconn(conn)
+        if prewarm_cache:
+            self.__execute(self.__prewarm_cache)
+
+    def close(self) -> None:
+        self.pool.closeall()
+        self.__prepared_connections.clear()
+
+    def __enter__(self) -> PersonStoragePostgres:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @contextmanager
+    def __connection(self) -> Iterator[connection]:
+        self.__available_connections.acquire()
+        try:
+            conn = self.pool.getconn()
+        except BaseException:
+            # Reconnecting failed, the permit is released for the retries
+            self.__available_connections.release()
+            raise
+        try:
+            if conn not in self.__prepared_connections:
+                with conn, conn.cursor() as cur:
+                    self.__prepare_statements(cur)
+                self.__prepared_connections.add(conn)
+            yield conn
+        finally:
+            self.pool.putconn(conn, close=bool(conn.closed))
+            # Closed either before or by putconn
+            if conn.closed:
+                self.__prepared_connections.discard(conn)
+            self.__available_connections.release()
+
+    def __execute(self, func: Callable[[cursor], T]) -> T:
+        # Runs func in one transaction on a pooled connection, retrying it on transient errors
+        for attempt in range(self.retries + 1):
+            try:
+                with self.__connection() as conn, conn, conn.cursor() as cur:
+                    return func(cur)
+            except self.TRANSIENT_ERRORS:
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+    def __prepare(self, cur: cursor):
+        for create_table in CREATE_TABLES:
+            cur.execute(create_table)
+
+    def __prepare_statements(self, cur: cursor):
+        for table in NAME_TABLES:
+            cur.execute(f'prepare upsert_{table} (text[]) as {UPSERT_NAMES.format(table=table)}')
+        cur.execute(f'prepare insert_works ({", ".join(INSERT_WORKS_TYPES)}) as {INSERT_WORKS}')
+
+    def __prewarm_cache(self, cur: cursor):
+        for table, cache in self.name_id_caches.items():
+            cur.execute(f'select norm_name, id from {table} order by id desc limit %s', (cache.maxsize,))
+            cache.put_many(dict(reversed(cur.fetchall())))
+
+    def index_persons(self, batch_size: int = 2 ** 14) -> None:
+        # Adds the persons stored before the index was attached
+        if self.person_index is None:
+            raise ValueError('The storage has no person index')
+
+        def _index_persons(cur: cursor) -> None:
+            cur.execute('select norm_name, id from Person order by id')
+            for rows in iter(lambda: cur.fetchmany(batch_size), []):
+                self.person_index.add_many(dict(rows))
+
+        self.__execute(_index_persons)
+
+    def cache_info(self) -> Dict[str, CacheInfo]:
+        return {table: cache.cache_info() for table, cache in self.name_id_caches.items()}
+
+    def push_person_info(self, info: List[TextPersonInfo], source_id: str) -> None:
+        self.push_person_info_many([(source_id, info)])
+
+    def push_person_info_many(self, infos: Iterable[Tuple[str, List[TextPersonInfo]]]) -> None:
+        infos = list(infos)
+        person_ids, job_ids, company_ids = self.__execute(lambda cur: self.__push_person_info_many(cur, infos))
+        # Only committed ids may be cached
+        self.name_id_caches['Person'].put_many(person_ids)
+        self.name_id_caches['Job'].put_many(job_ids)
+        self.name_id_caches['Company'].put_many(company_ids)
+        if self.person_index is not None:
+            self.person_index.add_many(person_ids)
+
+    def __push_person_info_many(self, cur: cursor, infos: List[Tuple[str, List[TextPersonInfo]]]) \
+            -> Tuple[Dict[str, int], Dict[str, int], Dict[str, int]]:
+        person_names, job_names, company_names = eval_names(infos)
+        person_ids = self.__upsert_names(cur, 'Person', person_names) if self.person_index is None \
+            else self.__resolve_persons(cur, person_names)
+        job_ids = self.__upsert_names(cur, 'Job', job_names)
+        company_ids = self.__upsert_names(cur, 'Company', company_names)
+        works = eval_work_rows(infos, person_ids, job_ids, company_ids)
+        if works:
+            # A column of only None is sent as ARRAY[NULL, ...] typed text[], which execute does not coerce
+            cur.execute(
+                f'execute insert_works ({", ".join(f"%s::{type_}" for type_ in INSERT_WORKS_TYPES)})',
+                [list(column) for column in zip(*works)]
+            )
+        return person_ids, job_ids, company_ids
+
+    def __upsert_names(self, cur: cursor, table: str, names: Iterable[str]) -> Dict[str, int]:
+        ids, missing = self.name_id_caches[table].get_many(names)
+        if missing:
+            cur.execute(f'execute upsert_{table} (%s)', (sorted(missing),))
+            ids.update(cur.fetchall())
+        return ids
+
+    def __resolve_persons(self, cur: cursor, names: Iterable[str]) -> Dict[str, int]:
+        ids, missing = self.name_id_caches['Person'].get_many(names)
+        ids.update(self.person_index.resolve_many(missing))
+        # Persons new to the index are stored once per group of names
+        groups = group_names(name for name in missing if name not in ids)
+        ids.update(self.__upsert_names(cur, 'Person', set(groups.values())))
+        ids.update((name, ids[group]) for name, group in groups.items())
+        return ids
+
+
+def eval_names(infos: List[Tuple[str, List[TextPersonInfo]]]) -> Tuple[set[str], set[str], set[str]]:
+    persons_info = [person_info for _, info in infos for person_info in info]
+    person_names = {person_info.norm_name for person_info in persons_info}
+    job_names = {job for person_info in persons_info for job in person_info.jobs_norm_names}
+    company_names = {company for person_info in persons_info for company in person_info.companies_norm_names}
+    return person_names, job_names, company_names
 
-        def __get_ids_by_names(table: str, names: List[str]) -> List[str]:
-            if not names:
-                return []
-            names_req_list = (f"'{name}'" for name in names)
-            names_req_list = f"({', '.join(names_req_list)})"
-            request = f'select id from {table} where norm_name in {names_req_list}'
-            self.cur.execute(request)
-            return [row[0] for row in self.cur.fetchall()]
 
+def eval_work_rows(infos: List[Tuple[str, List[TextPersonInfo]]], person_ids: Dict[str, int],
+                   job_ids: Dict[str, int], company_ids: Dict[str, int]) -> List[tuple]:
+    works = []
+    for source_id, info in infos:
         for person_info in info:
-            self.cur.execute(insert_person.substitute(norm_name=person_info.norm_name))
-            for job in person_info.jobs_norm_names:
-                self.cur.execute(insert_job.substitute(norm_name=job))
-            for company in person_info.companies_norm_names:
-                self.cur.execute(insert_company.substitute(norm_name=company))
-            self.conn.commit()
-            person_id = __get_ids_by_names("Person", [person_info.norm_name])[0]
+            person_id = person_ids[person_info.norm_name]
             for work in person_info.work:
-                company_ids = __get_ids_by_names("Company", work.companies_norm_names) or [self.NULL]
-                if [self.NULL] == company_ids:
+                work_company_ids = {company_ids[company] for company in work.companies_norm_names}
+                if not work_company_ids:
                     continue
-                job_ids = __get_ids_by_names("Job", work.jobs_norm_names) or [self.NULL]
-                for (job_id, company_id) in product(job_ids, company_ids):
-                    self.cur.execute(
-                        insert_work.substitute(
-                            person=person_id,
-                            company=company_id,
-                            job=job_id,
-                            start_year=work.start_time.year if work.start_time and work.start_time.year else self.NULL,
-                            start_month=work.start_time.month
-                                if work.start_time and work.start_time.month else self.NULL,
-                            end_year=work.end_time.year if work.end_time and work.end_time.year else self.NULL,
-                            end_month=work.end_time.month if work.end_time and work.end_time.month else self.NULL,
-                            source_id=source_id
-                        )
-                    )
-                    self.conn.commit()
+                work_job_ids = {job_ids[job] for job in work.jobs_norm_names} or {None}
+                start_year = work.start_time and work.start_time.year or None
+                start_month = work.start_time and work.start_time.month or None
+                end_year = work.end_time and work.end_time.year or None
+                end_month = work.end_time and work.end_time.month or None
+                works.extend(
+                    (person_id, company_id, job_id, start_year, start_month, end_year, end_month, source_id)
+                    for job_id, company_id in product(work_job_ids, work_company_ids)
+                )
+    return works
@@ -1,6 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import sys
+import threading
+import timeit
+from typing import List, Optional
+from unittest.mock import patch
+
+import psycopg2
+
+from person.storage.async_person_storage import AsyncPersonStoragePostgres
+from person.storage.person_index import PersonIndexSqlite, group_names
 from person.storage.person_storage import PersonStoragePostgres
+from person.employment_info.domain import Token, EntityType, Work, TimeStamp, TextPersonInfo
 from person.employment_info.services import PersonInfoExtractor
 
 # text = """
@@ -724,8 +736,223 @@ Sberbank CIB в мае 2018 года выпустил отчёт, в котор
 """
 
 
+def token(norm_text: str, entity: EntityType) -> Token:
+    return Token(norm_text, 0, len(norm_text), norm_text, 0, len(norm_text), entity)
+
+
+def person_info(name: str, company: str) -> TextPersonInfo:
+    return TextPersonInfo(set(name.split()), [Work(token(name, EntityType.PER), [token(company, EntityType.ORG)], [])])
+
+
+def test_person_index() -> None:
+    with PersonIndexSqlite(':memory:') as index:
+        index.add_many({'аркадий волож': 1, 'борис ротенберг': 2, 'аркадий ротенберг': 3})
+        assert index.resolve_many(['волож', 'аркадий юрьевич волож', 'ротенберг', 'аркадий', 'илья сегалович']) == {
+            'волож': 1, 'аркадий юрьевич волож': 1
+        }
+        index.add_many({'ротенберг': 4})
+        assert index.resolve_many(['ротенберг', 'борис ротенберг']) == {'ротенберг': 4, 'борис ротенберг': 2}
+    assert group_names(['аркадий волож', 'волож', 'аркадий', 'аркадий ротенберг']) == {
+        'аркадий волож': 'аркадий волож', 'волож': 'аркадий волож',
+        'аркадий ротенберг': 'аркадий ротенберг', 'аркадий': 'аркадий'
+    }
+    print('person index: ok')
+
+
+def fetch_all(storage: PersonStoragePostgres, query: str, params: Optional[tuple] = None) -> List[tuple]:
+    conn = storage.pool.getconn()
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute(query, params)
+            return cur.fetchall() if cur.description else []
+    finally:
+        storage.pool.putconn(conn)
+
+
+def test_resolve_persons(database: str, user: str, password: str) -> None:
+    # Each name is pushed with itself as the source id
+    def push(storage: PersonStoragePostgres, *names: str) -> None:
+        storage.push_person_info_many(
+            (f'test_resolve_persons {name}', [person_info(name, 'тестовая компания')]) for name in names
+        )
+
+    def person_id(storage: PersonStoragePostgres, name: str) -> int:
+        (person,), = fetch_all(
+            storage, 'select distinct person from Work where source_id = %s', (f'test_resolve_persons {name}',)
+        )
+        return person
+
+    with PersonStoragePostgres(database, user, password) as storage:
+        # The persons of the previous runs would be matched as well
+        fetch_all(storage, "delete from Work where source_id like 'test_resolve_persons %'")
+        fetch_all(
+            storage, "delete from Person where norm_name like 'тестовый%' and id not in (select person from Work)"
+        )
+        push(storage, 'тестовый аркадий волож')
+    with PersonIndexSqlite(':memory:') as index, \
+            PersonStoragePostgres(database, user, password, person_index=index) as storage:
+        # Stored before the index was attached
+        storage.index_persons()
+        push(storage, 'тестовый волож', 'тестовый борис ротенберг', 'тестовый ротенберг')
+        push(storage, 'тестовый аркадий ротенберг')
+        push(storage, 'тестовый')
+        ids = {
+            name: person_id(storage, name) for name in (
+                'тестовый аркадий волож', 'тестовый волож', 'тестовый борис ротенберг', 'тестовый ротенберг',
+                'тестовый аркадий ротенберг', 'тестовый'
+            )
+        }
+    assert ids['тестовый волож'] == ids['тестовый аркадий волож']
+    assert ids['тестовый ротенберг'] == ids['тестовый борис ротенберг']
+    assert len(set(ids.values())) == 4
+    print('resolve persons: ok')
+
+
+def test_push_sparse_works(storage: PersonStoragePostgres) -> None:
+    # Works without jobs or months leave whole insert columns None
+    person = token('тестовый сотрудник', EntityType.PER)
+    works = [
+        Work(person, [token('тестовая компания', EntityType.ORG)], []),
+        Work(
+            person, [token('другая тестовая компания', EntityType.ORG)], [],
+            TimeStamp(2001, 0, 0), TimeStamp(2003, 0, 0)
+        ),
+    ]
+    storage.push_person_info([TextPersonInfo({'тестовый', 'сотрудник'}, works)], 'test_push_sparse_works')
+    works = fetch_all(
+        storage,
+        # Null columns never conflict, so each run inserts the works again
+        'select distinct job, start_year, start_month, end_year, end_month from Work where source_id = %s order by 2',
+        ('test_push_sparse_works',)
+    )
+    assert works == [(None, 2001, None, 2003, None), (None, None, None, None, None)]
+    print('push sparse works: ok')
+
+
+def test_failed_checkout(database: str, user: str, password: str) -> None:
+    # A failed reconnect must not take a connection permit for good
+    with PersonStoragePostgres(database, user, password, max_connections=2, retries=1, retry_delay=0) as storage:
+        info = [person_info('тестовый сотрудник', 'тестовая компания')]
+        with patch.object(storage.pool, 'getconn', side_effect=psycopg2.OperationalError('database is down')):
+            try:
+                storage.push_person_info(info, 'test_failed_checkout')
+            except psycopg2.OperationalError:
+                pass
+            else:
+                raise AssertionError('push without a connection succeeded')
+        pushes = [
+            threading.Thread(target=storage.push_person_info, args=(info, 'test_failed_checkout'), daemon=True)
+            for _ in range(4)
+        ]
+        for push in pushes:
+            push.start()
+        for push in pushes:
+            push.join(timeout=10)
+        assert not any(push.is_alive() for push in pushes)
+    print('failed checkout: ok')
+
+
+def test_name_id_cache(database: str, user: str, password: str) -> None:
+    info = [person_info(f'тестовый кэш {i}', f'тестовая компания {i}') for i in range(3)]
+    names = [name for person in info for name in (person.norm_name, *person.companies_norm_names)]
+
+    def row_versions(storage: PersonStoragePostgres) -> List[tuple]:
+        # An upsert rewrites its rows even when the names exist, changing their xmin
+        return fetch_all(
+            storage,
+            """
+            select norm_name, xmin::text from Person where norm_name = any(%s)
+            union all select norm_name, xmin::text from Company where norm_name = any(%s)
+            order by 1
+            """,
+            (names, names)
+        )
+
+    with PersonStoragePostgres(database, user, password) as storage:
+        storage.push_person_info(info, 'test_name_id_cache')
+        versions = row_versions(storage)
+        before = storage.cache_info()
+        storage.push_person_info(info, 'test_name_id_cache')
+        after = storage.cache_info()
+        for table in ('Person', 'Company'):
+            assert after[table].hits - before[table].hits == len(info)
+            assert after[table].misses == before[table].misses
+        assert row_versions(storage) == versions
+    with PersonStoragePostgres(database, user, password, prewarm_cache=True) as storage:
+        assert all(storage.cache_info()[table].currsize for table in ('Person', 'Company'))
+        storage.push_person_info(info, 'test_name_id_cache')
+        assert not any(cache_info.misses for cache_info in storage.cache_info().values())
+        assert row_versions(storage) == versions
+    print('name id cache: ok')
+
+
+def test_async_storage(database: str, user: str, password: str, text_persons: List[TextPersonInfo]) -> None:
+    class Extractor:
+        # Persons of the text ids, failing on the ids starting with 'boom'
+        def extract(self, text_id: str) -> List[TextPersonInfo]:
+            if text_id.startswith('boom'):
+                raise ValueError(text_id)
+            return [person_info(f'тестовый {text_id}', 'тестовая компания')]
+
+    def works(storage: PersonStoragePostgres, source_id: str) -> List[tuple]:
+        return fetch_all(
+            storage,
+            """
+            select distinct Person.norm_name, Company.norm_name, Job.norm_name, start_year, start_month, end_year,
+                            end_month
+            from Work join Person on Person.id = Work.person join Company on Company.id = Work.company
+            left join Job on Job.id = Work.job
+            where source_id = %s order by 1, 2, 3, 4, 5, 6, 7
+            """,
+            (source_id,)
+        )
+
+    async def push() -> None:
+        async with await AsyncPersonStoragePostgres.connect(database, user, password) as storage:
+            await storage.push_person_info(text_persons, 'test_async_storage async')
+            try:
+                texts = [(f'test_async_storage {text_id}', text_id) for text_id in ('первый', 'boom', 'второй')]
+                await storage.push_extracted(Extractor(), texts, batch_size=1)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('extraction error was not raised')
+
+    with PersonStoragePostgres(database, user, password) as storage:
+        fetch_all(storage, "delete from Work where source_id like 'test_async_storage %'")
+        storage.push_person_info(text_persons, 'test_async_storage sync')
+        asyncio.run(push())
+        assert works(storage, 'test_async_storage async') == works(storage, 'test_async_storage sync')
+        # The batch pushed before the failed extraction is committed, the later ones are not pushed
+        assert works(storage, 'test_async_storage первый')
+        assert not works(storage, 'test_async_storage второй')
+    print('async storage: ok')
+
+
+def benchmark_prepared_statements(storage: PersonStoragePostgres, text_persons, number: int = 100) -> None:
+    elapsed = timeit.timeit(lambda: storage.push_person_info(text_persons, 'benchmark'), number=number)
+    print(f'push_person_info: {elapsed / number:.4f}s')
+    conn = storage.pool.getconn()
+    with conn.cursor() as cur:
+        cur.execute('select name, generic_plans, custom_plans from pg_prepared_statements order by name')
+        for name, generic_plans, custom_plans in cur.fetchall():
+            print(f'{name}: generic plans {generic_plans}, custom plans {custom_plans}')
+    storage.pool.putconn(conn)
+
+
 if __name__ == '__main__':
     text_persons = PersonInfoExtractor().extract(text)
+    if 'benchmark' in sys.argv[1:]:
+        with PersonStoragePostgres('postgres', 'postgres', 'abota5432', max_connections=1) as storage:
+            benchmark_prepared_statements(storage, text_persons)
+        sys.exit()
+    test_person_index()
+    test_resolve_persons('postgres', 'postgres', 'abota5432')
+    test_failed_checkout('postgres', 'postgres', 'abota5432')
+    test_name_id_cache('postgres', 'postgres', 'abota5432')
+    test_async_storage('postgres', 'postgres', 'abota5432', text_persons)
+    with PersonStoragePostgres('postgres', 'postgres', 'abota5432') as storage:
+        test_push_sparse_works(storage)
     # for info in text_persons:
     #     print(info.norm_name)
     #     for work in info.work: